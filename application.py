@@ -1,10 +1,11 @@
-from config import config
+from config import config, paths
 from discriminator import Discriminator
 from helper import store, get_logger
 
 import torch
 import generator
 import loader
+import tokens
 import tree
 import os
 
@@ -15,14 +16,14 @@ def store_results(loss, reward_without_log_prob, entropy, prediction, policy):
     store.get('List: Mean Entropies Per Generator Step').append(entropy)
     store.get('List: Mean Predictions Per Generator Step').append(prediction)
 
-    mean_policies = store.get('List: Mean Policies Per Single Step')
-    mean_policies = torch.mean(torch.stack(mean_policies, dim=0), dim=0).cpu().detach()
+    mean_policies = store.get('Tensor: Mean Policies Per Single Step')
+    mean_policies = torch.mean(mean_policies, dim=0).cpu().detach()
     store.get('List: Mean Policies Per Generator Step').append(mean_policies)
 
     # calculate tuples of (action_id, count, average probability, average reward)
-    sampled_actions = store.get('List: Sampled Actions Per Single Step')
-    log_probs = store.get('List: Log Probabilites Per Actions Of Single Step')
-    rewards = store.get('List: Rewards Per Single Step')
+    sampled_actions = store.get('Tensor: Sampled Actions Per Single Step')
+    log_probs = store.get('Tensor: Log Probabilites Per Actions Of Single Step')
+    rewards = store.get('Tensor: Rewards Per Single Step')
 
     action_counts = {}
     action_probs = {}
@@ -60,39 +61,39 @@ def store_results(loss, reward_without_log_prob, entropy, prediction, policy):
         policy.save('{}/policies/{}'.format(store.folder, step))
 
 
-def policy_gradient(policy):
-    policy.optimizer.zero_grad()
+def policy_gradient(policy, step, g_steps):
+    # accumulate gradients over several steps to raise the effective batch size
+    if step % config.accumulation_steps == 0:
+        policy.optimizer.zero_grad()
 
     # weight state action values by log probability of action
-    total = torch.zeros(config.batch_size, device=config.device)
-    reward_with_log_prob = torch.zeros(config.batch_size, device=config.device)
-    reward_without_log_prob = torch.zeros(config.batch_size, device=config.device)
+    log_probs = store.get('Tensor: Log Probabilites Per Actions Of Single Step')
+    rewards = store.get('Tensor: Rewards Per Single Step')
 
-    log_probs = store.get('List: Log Probabilites Per Actions Of Single Step')
-    rewards = store.get('List: Rewards Per Single Step')
+    assert log_probs.size() == rewards.size()
+    assert log_probs.size(1) == config.batch_size
 
-    assert len(rewards) == len(log_probs)
-    assert all(tensor.size() == (config.batch_size,) for tensor in log_probs)
-    assert all(tensor.size() == (config.batch_size,) for tensor in rewards)
-
-    for log_prob, reward in zip(log_probs, rewards):
-        total = total + (reward - config.g_baseline)
-        reward_with_log_prob = reward_with_log_prob + (log_prob * total)
-        reward_without_log_prob = reward_without_log_prob + total
+    # running totals over the sequence as a single cumulative sum over the step dimension
+    totals = torch.cumsum(rewards - config.g_baseline, dim=0)
+    reward_with_log_prob = torch.sum(log_probs * totals, dim=0)
+    reward_without_log_prob = torch.sum(totals, dim=0)
 
     # average over batchsize
     reward_without_log_prob = torch.sum(reward_without_log_prob) / config.batch_size
     reward_with_log_prob = torch.sum(reward_with_log_prob) / config.batch_size
 
     # negate for gradient descent and substract entropy
-    entropies = store.get('List: Mean Entropies Per Single Step')
-    entropy = 0.01 * sum(entropies) / len(entropies)
+    entropies = store.get('Tensor: Mean Entropies Per Single Step')
+    entropy = 0.01 * torch.mean(entropies)
 
     loss = - (reward_with_log_prob + entropy)
-    loss.backward()
-    policy.optimizer.step()
+    (loss / config.accumulation_steps).backward()
+
+    # flush on the last step of the enclosing loop so a trailing partial group is not dropped
+    if (step + 1) % config.accumulation_steps == 0 or step == g_steps - 1:
+        policy.optimizer.step()
 
-    prediction = sum(rewards[-1]) / config.batch_size
+    prediction = torch.sum(rewards[-1]) / config.batch_size
     store_results(loss.item(), reward_without_log_prob.item(), entropy.item(), prediction.item(), policy)
 
 
@@ -107,15 +108,19 @@ def collect_reward(discriminator, batch):
     """
 
     images = loader.prepare_batch(batch)
-    output = discriminator(images)
-    reward = torch.empty((batch.shape[0], 1), device=config.device)
+    images = images.contiguous(memory_format=torch.channels_last)
+
+    with torch.cuda.amp.autocast(enabled=config.device.type == 'cuda'):
+        output = discriminator(images)
+
+    # the net returns logits, take the sigmoid in full precision outside of autocast
+    output = torch.sigmoid(output.float())
 
     # TODO punish atomic expressions
     # TODO minimize negative output instead of maximizing 1-output !
 
-    for r in range(output.shape[0]):
-        # reward[r][0] = 1 - output[r]
-        reward[r][0] = - output[r]
+    # reward = (1 - output).view(-1, 1)
+    reward = - output.view(-1, 1)
 
     return reward
 
@@ -141,42 +146,55 @@ def adversarial_generator(policy, rollout, discriminator, adversarial_step, g_st
 
         print('Global Step {} - Generator Step {}'.format(adversarial_step, step))
 
-        # temporary store - necessary for loss calculation - should be overwritten each step
-        store.set('List: Log Probabilites Per Actions Of Single Step', [])
-        store.set('List: Rewards Per Single Step', [])
-        store.set('List: Mean Entropies Per Single Step', [])
+        # temporary store - necessary for loss calculation - preallocated and overwritten each step
+        store.set('Tensor: Log Probabilites Per Actions Of Single Step',
+                  torch.empty(config.sequence_length, config.batch_size, device=config.device))
+        store.set('Tensor: Rewards Per Single Step',
+                  torch.empty(config.sequence_length, config.batch_size, device=config.device))
+        store.set('Tensor: Mean Entropies Per Single Step',
+                  torch.empty(config.sequence_length, device=config.device))
 
-        # temporary store - not necessary for loss calculation - should be overwritten each step
-        store.set('List: Sampled Actions Per Single Step', [])
-        store.set('List: Mean Policies Per Single Step', [])
+        # temporary store - not necessary for loss calculation - preallocated and overwritten each step
+        store.set('Tensor: Sampled Actions Per Single Step',
+                  torch.empty(config.sequence_length, config.batch_size, dtype=torch.long, device=config.device))
+        store.set('Tensor: Mean Policies Per Single Step',
+                  torch.empty(config.sequence_length, tokens.count(), device=config.device))
 
         batch, hidden = policy.initial()
 
         for length in range(config.sequence_length):
 
             # generate a single next token given the sequences generated so far
-            batch, hidden = generator.step(policy, batch, hidden, save_prob=True)
-            q_values = torch.empty([config.batch_size, 0], device=config.device)
+            batch, hidden = generator.step(policy, batch, hidden, save_prob=True, t=length)
 
-            # compute the Q(token,subsequence) values with monte carlo approximation
-            if not batch.shape[1] < config.sequence_length:
-                for _ in range(config.montecarlo_trials):
-                    samples = generator.rollout(rollout, batch, hidden)
+            # the empty start token is known to be at the front, remove it once
+            if length == 0:
+                batch = batch[:, 1:, :]
+
+            # compute the Q(token,subsequence) values with monte carlo approximation, all trials are batched into a
+            # single expanded rollout so the discriminator sees one large batch instead of montecarlo_trials small ones
+            with torch.inference_mode():
+                if not batch.shape[1] < config.sequence_length:
+                    trial_batch = batch.repeat_interleave(config.montecarlo_trials, dim=0)
+                    trial_hidden = hidden.repeat_interleave(config.montecarlo_trials, dim=1)
+
+                    samples = generator.rollout(rollout, trial_batch, trial_hidden)
                     reward = collect_reward(discriminator, samples)
-                    q_values = torch.cat([q_values, reward], dim=1)
-            else:
-                reward = collect_reward(discriminator, batch)
-                q_values = torch.cat([q_values, reward], dim=1)
+                    q_values = reward.view(config.batch_size, config.montecarlo_trials)
+                else:
+                    q_values = collect_reward(discriminator, batch)
 
-            # average the reward over all trials
-            q_values = torch.mean(q_values, dim=1)
-            store.get('List: Rewards Per Single Step').append(q_values)
+                # average the reward over all trials
+                q_values = torch.mean(q_values, dim=1)
+
+            # clone to leave inference mode, the rewards enter the loss computation later
+            store.get('Tensor: Rewards Per Single Step')[length] = q_values.clone()
 
             # generator.policy_gradient_update(policy)  # TODO comment out to reward like in SeqGAN
             # batch, hidden = (batch.detach(), hidden.detach())  # TODO comment out to reward like in SeqGAN
 
-        store.get('List: Formular Examples').append(', '.join(tree.to_latex(batch[-3:].tolist())))
-        policy_gradient(policy)
+        store.get('List: Formular Examples').append(', '.join(tree.to_latex(batch[-3:].argmax(dim=-1).tolist())))
+        policy_gradient(policy, step, g_steps)
 
 
 def adversarial_discriminator(discriminator, policy, adversarial_step, d_steps, d_epochs):
@@ -191,33 +209,44 @@ def adversarial_discriminator(discriminator, policy, adversarial_step, d_steps,
     data_loader = loader.prepare_loader(num_samples, policy)
 
     for epoch in range(d_epochs):
-        store.set('Discriminator Loss Per Batch', [])
-        store.set('Discrmininator Accuracy Per Batch', [])
-
         print('Global Step {} - Discriminator Epoch {}'.format(adversarial_step, epoch))
 
-        for images, labels in data_loader:
-            images = images.to(config.device)
-            labels = labels.to(config.device)
+        # accumulate on the device, every .item() call would synchronize with the gpu
+        running_loss = torch.zeros((), device=config.device)
+        running_correct = torch.zeros((), device=config.device)
+        num_batches = 0
+        num_samples = 0
+
+        for batch_index, (images, labels) in enumerate(data_loader):
+            images = images.to(config.device, non_blocking=True)
+            labels = labels.to(config.device, non_blocking=True)
 
-            discriminator.optimizer.zero_grad()
-            outputs = discriminator(images)
+            # accumulate gradients over several batches to raise the effective batch size
+            if batch_index % config.accumulation_steps == 0:
+                discriminator.optimizer.zero_grad()
 
-            # output[:,0] P(x ~ real)
-            # output[:,1] P(x ~ synthetic)
+            with torch.cuda.amp.autocast(enabled=config.device.type == 'cuda'):
+                outputs = discriminator(images)
 
+            # the net returns logits, P(x ~ synthetic) = sigmoid(logit)
+
+            # BCEWithLogitsLoss fuses the sigmoid into the loss, which is the autocast safe form,
+            # still computed in full precision
+            outputs = outputs.float()
             loss = discriminator.criterion(outputs, labels.float())
-            loss.backward()
-            discriminator.optimizer.step()
+            discriminator.scaler.scale(loss / config.accumulation_steps).backward()
+
+            if (batch_index + 1) % config.accumulation_steps == 0 or batch_index == len(data_loader) - 1:
+                discriminator.scaler.step(discriminator.optimizer)
+                discriminator.scaler.update()
 
-            store.get('Discriminator Loss Per Batch').append(loss.item())
-            store.get('Discrmininator Accuracy Per Batch').append(torch.sum((outputs > 0.5) == (labels == 1)).item()
-                                                                  / outputs.shape[0])
+            running_loss += loss.detach()
+            running_correct += torch.sum((outputs > 0) == (labels == 1))
+            num_batches += 1
+            num_samples += outputs.shape[0]
 
-        loss = store.get('Discriminator Loss Per Batch')
-        acc = store.get('Discrmininator Accuracy Per Batch')
-        store.get('Discriminator Loss').append(sum(loss) / len(loss))
-        store.get('Discriminator Accuracy').append(sum(acc) / len(acc))
+        store.get('Discriminator Loss').append(running_loss.item() / num_batches)
+        store.get('Discriminator Accuracy').append(running_correct.item() / num_samples)
 
 
 def training(discriminator, policy, rollout):
@@ -239,24 +268,29 @@ def training(discriminator, policy, rollout):
     return discriminator, policy
 
 
-def initialize():
+def initialize(rank=None):
     """
     Setup neural networks and tensorboard logging.
+
+    :param rank: The rank of the calling process in a distributed run, None for single process training. Used to keep
+        result directories of the processes apart.
     """
 
-    discriminator = Discriminator().to(config.device)
+    discriminator = Discriminator().to(config.device, memory_format=torch.channels_last)
     policy = generator.Policy().to(config.device)
     rollout = generator.Policy().to(config.device)
 
-    discriminator.criterion = torch.nn.BCELoss()
+    discriminator.criterion = torch.nn.BCEWithLogitsLoss()
     discriminator.optimizer = torch.optim.Adam(discriminator.parameters(), lr=config.d_learnrate)
+    discriminator.scaler = torch.cuda.amp.GradScaler(enabled=config.device.type == 'cuda')
     policy.optimizer = torch.optim.Adam(policy.parameters(), lr=config.g_learnrate)
 
     hyperparameter = {k: v for k, v in config.__dict__.items() if not v == config.device}
 
     notes = ''''''
 
-    store.setup(loader.make_directory_with_timestamp(), hyperparameter, notes)
+    suffix = '' if rank is None else '-rank{}'.format(rank)
+    store.setup(loader.make_directory_with_timestamp(suffix), hyperparameter, notes)
     store.set('Policy Step', 0)
     os.makedirs('{}/policies'.format(store.folder))
 
@@ -265,7 +299,102 @@ def initialize():
     return discriminator, policy, rollout,  log
 
 
+class Distributed(torch.nn.parallel.DistributedDataParallel):
+    """
+    A thin wrapper around DistributedDataParallel which keeps the interface of the wrapped net intact. Attribute
+    lookups that DistributedDataParallel does not know, f.e. the optimizer or the save method, fall through to the
+    wrapped module, and state dicts are exposed without the module prefix so weights stay exchangeable with the
+    single process nets.
+    """
+
+    def __getattr__(self, name):
+        try:
+            return super(Distributed, self).__getattr__(name)
+        except AttributeError:
+            return getattr(self.module, name)
+
+    def reset(self):
+        self.module.reset()
+
+        # parameters are only broadcast at construction and each rank resets with its own rng state,
+        # realign the replicas so the averaged gradients apply to identical weights again
+        for parameter in self.module.parameters():
+            torch.distributed.broadcast(parameter.data, src=0)
+
+    def state_dict(self, *args, **kwargs):
+        return self.module.state_dict(*args, **kwargs)
+
+    def load_state_dict(self, *args, **kwargs):
+        return self.module.load_state_dict(*args, **kwargs)
+
+
+def ddp_main(rank, world_size):
+    """
+    The per process entry point of the distributed training. Each process drives one GPU, gradients of the policy and
+    the discriminator get averaged across processes by DistributedDataParallel with the nccl backend. The rollout net
+    never computes gradients and stays a plain local copy. Only the process with rank 0 saves the final results.
+
+    :param rank: The rank of this process with rank=0,1,..,world_size-1.
+    :param world_size: The total amount of processes participating in the training.
+    """
+
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '29500')
+
+    torch.distributed.init_process_group(backend='nccl', rank=rank, world_size=world_size)
+    torch.cuda.set_device(rank)
+
+    config.device = torch.device('cuda', rank)
+    config.num_real_samples = config.num_real_samples // world_size  # each process trains on its own share
+
+    # the synthetic data directory is scratch space that gets cleared on every batch, sharing it between
+    # ranks would delete and overwrite files another rank is still reading
+    paths.synthetic_data = paths.synthetic_data + '-rank{}'.format(rank)
+
+    log = None
+
+    try:
+        # let rank 0 build the directories, the arxiv index and its ray instance first, the remaining ranks
+        # then read the cached index instead of racing on the pickle file
+        if rank == 0:
+            loader.initialize(num_processes=world_size)
+
+        torch.distributed.barrier()
+
+        if rank > 0:
+            loader.initialize(num_processes=world_size)
+
+        # all ranks walk the corpus inorder at the same rate, starting each one in its own partition keeps
+        # the shards disjoint, without the offset every rank would read the identical first slice
+        loader.arxiv_dataset.index = rank * (len(loader.arxiv_dataset) // world_size)
+
+        discriminator, policy, rollout, log = initialize(rank)
+
+        discriminator = Distributed(discriminator, device_ids=[rank])
+
+        # the generator runs sequence_length forward passes before a single backward, the reducer only
+        # supports that with a static graph
+        policy = Distributed(policy, device_ids=[rank], static_graph=True)
+
+        training(discriminator, policy, rollout)
+
+        if rank == 0:
+            loader.finish(policy, discriminator)
+
+    except Exception as e:
+        print(str(e))
+        log.error(str(e))
+
+    torch.distributed.destroy_process_group()
+
+
 def application():
+    world_size = torch.cuda.device_count()
+
+    if world_size > 1:
+        torch.multiprocessing.spawn(ddp_main, args=(world_size,), nprocs=world_size)
+        return
+
     log = None
 
     try:
@@ -45,6 +45,7 @@ class Config:
 
     batch_size: int
     montecarlo_trials: int
+    accumulation_steps: int
 
     sequence_length: int
 
@@ -104,6 +105,7 @@ DEFAULT_CONFIG = Config(
 
     batch_size=multiprocessing.cpu_count() * 4,  # computational cost reasons
     montecarlo_trials=10,  # 10
+    accumulation_steps=4,  # optimizer steps every n batches, 1 to disable
 
     sequence_length=20,  # 20
 
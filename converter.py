@@ -48,7 +48,10 @@ def conversion(pid, offset, sequences, directory, file_count):
     end_index = min(end_index, len(sequences))
 
     latex = template.get_template(sequences[start_index:end_index])
-    name = str(file_count + start_index)
+
+    # zero pad to the width of the ghostscript page suffix, the ordered dataset sorts file names as
+    # strings and unpadded prefixes would permute the worker blocks
+    name = '{:09d}'.format(file_count + start_index)
 
     file = pdflatex(latex, directory, name)
     file = pdf2png(directory, file, name)
@@ -56,40 +59,74 @@ def conversion(pid, offset, sequences, directory, file_count):
     return True
 
 
-def convert_to_png(batch, directory) -> None:
+def prepare_preamble(directory) -> None:
     """
-    This function takes a batch of seqences or a list of batches in form of onehot encodings and converts them to
-    the .png format. Lists of batches are encouraged to justify the multiprocessing overhead.
+    This function makes sure the precompiled preamble is available in the given directory. pdflatex reads the
+    format file on every compilation, so it has to be in place and complete before any conversion tasks are
+    dispatched against the directory, copying it while workers are running truncates the file under them.
 
-    :param sequences: An array of size (batch size, sequence length, onehot length) is expected. This function
-        assumes that the given onehot encodings in the array are valid. A list of batches is also allowed.
-    :param directory: The directory path where the png files will get saved. The function assumes the directory exists.
+    :param directory: The directory path which the conversion tasks will compile in.
     """
 
-    global NUM_CPUS, PREAMBLE_PATH
+    global PREAMBLE_PATH
 
     if not PREAMBLE_PRECOMPILED:
         precompile_preamble()
 
     shutil.copyfile(PREAMBLE_PATH, directory + '/preamble.fmt')
 
-    sequences = batch.tolist()
+
+def convert_to_png_async(batch, directory, file_count=None) -> list:
+    """
+    This function dispatches the latex to png conversion of a batch to the ray workers and returns the pending
+    result references without blocking. This allows overlapping the cpu heavy conversion with other work such as
+    sampling the next batch, call ray.get on the collected references to synchronize. The caller has to run
+    prepare_preamble on the directory once before dispatching.
+
+    :param batch: An array of size (batch size, sequence length, onehot length) is expected. This function
+        assumes that the given onehot encodings in the array are valid.
+    :param directory: The directory path where the png files will get saved. The function assumes the directory exists.
+    :param file_count: The amount of files assumed to be in the directory, used to generate unique file names.
+        Counted with os.listdir if omitted. Pass it explicitly when dispatching several batches before any of them
+        finished, the directory listing races with the workers writing files otherwise.
+    :return: Returns the list of pending ray result references.
+    """
+
+    global NUM_CPUS
+
+    # reduce the onehot encodings to token ids on the tensor before entering the python tree walk
+    sequences = batch.argmax(dim=-1).tolist()
     trees = tree.to_trees(sequences)
     latexs = [t.latex() for t in trees]
 
     num_sequences = len(latexs)
     cpus_used = min(num_sequences, NUM_CPUS)
     offset = math.ceil(num_sequences / cpus_used)
-    file_count = len(os.listdir(directory))
 
-    # copy to shared memory once instead of copying to each cpu
+    if file_count is None:
+        file_count = len(os.listdir(directory))
+
+    # copy the large sequence list to shared memory once instead of copying it to each cpu, the remaining
+    # arguments are small scalars which ray inlines into the task spec anyway, putting them only adds round trips
     latexs_id = ray.put(latexs)
-    offset_id = ray.put(offset)
-    directory_id = ray.put(directory)
-    file_count_id = ray.put(file_count)
+
+    return [conversion.remote(pid, offset, latexs_id, directory, file_count) for pid in range(cpus_used)]
+
+
+def convert_to_png(batch, directory) -> None:
+    """
+    This function takes a batch of seqences or a list of batches in form of onehot encodings and converts them to
+    the .png format. Lists of batches are encouraged to justify the multiprocessing overhead.
+
+    :param sequences: An array of size (batch size, sequence length, onehot length) is expected. This function
+        assumes that the given onehot encodings in the array are valid. A list of batches is also allowed.
+    :param directory: The directory path where the png files will get saved. The function assumes the directory exists.
+    """
+
+    prepare_preamble(directory)
 
     # no need for return value but call get for synchronisation
-    ray.get([conversion.remote(pid, offset_id, latexs_id, directory_id, file_count_id) for pid in range(cpus_used)])
+    ray.get(convert_to_png_async(batch, directory))
 
 
 def clean_up(directory) -> None:
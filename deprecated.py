@@ -22,16 +22,16 @@ class PolicyEvaluator:
 
     def _policy_step(self, nn_policy, batch, hidden):
         state = batch[:, -1, :][:, None, :]
-        policies, hidden = nn_policy(state, hidden)
+        log_policies, hidden = nn_policy(state, hidden)
 
-        distributions = torch.distributions.Categorical(policies)
+        distributions = torch.distributions.Categorical(logits=log_policies)
         actions = distributions.sample()
 
         encodings = torch.tensor([tokens.onehot(id) for id in actions])
         encodings = encodings[:, None, :].float()
         batch = torch.cat((batch, encodings), dim=1)
 
-        return policies, batch, hidden
+        return torch.exp(log_policies), batch, hidden
 
     def _policy_average(self, filepath):
         nn_policy = generator.Policy()
@@ -23,7 +23,6 @@ class Discriminator(nn.Module):
         self.fc5 = nn.Linear(32, 1)
 
         self.selu = nn.SELU()
-        self.sigmoid = nn.Sigmoid()
 
         self.loss = []
         self.acc = []
@@ -45,15 +44,17 @@ class Discriminator(nn.Module):
         out = self.selu(out)
         out = self.pool3x3(out)
 
-        out = out.view(-1, 5 * 32)
+        # flatten copes with the strides a channels last net propagates to here, view would raise
+        out = out.flatten(1)
         out = self.fc3(out)
         out = self.selu(out)
 
         out = self.fc4(out)
         out = self.selu(out)
 
+        # return raw logits, a sigmoid evaluated under autocast saturates to exact 0 and 1 in half
+        # precision, apply torch.sigmoid outside or use BCEWithLogitsLoss for training
         out = self.fc5(out)
-        out = self.sigmoid(out)
 
         out = out.squeeze()
 
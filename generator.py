@@ -9,9 +9,10 @@ import distribution
 
 class Policy(nn.Module):
     """
-    The policy net consists of two recurrent layers using GRUs, a fully connected layer and a softmax function so that
-    the output can be seen as distribution over the possible token choices. The output will be a tensor of size
-    (batch size, 1, one hot length) with each index of the one hot dimension representing a token choice.
+    The policy net consists of two recurrent layers using GRUs, a fully connected layer and a log softmax function so
+    that the output can be seen as log probabilities over the possible token choices. The log form is numerically more
+    stable than taking the logarithm of a softmax output. The output will be a tensor of size (batch size, 1, one hot
+    length) with each index of the one hot dimension representing a token choice.
     """
 
     def __init__(self):
@@ -25,8 +26,7 @@ class Policy(nn.Module):
 
         self.gru = nn.GRU(self.input_dim, self.hidden_dim, self.layers, batch_first=True, dropout=self.dropout)
         self.lin = nn.Linear(self.hidden_dim, self.output_dim)
-        self.relu = nn.ReLU()
-        self.softmax = nn.Softmax(dim=1)  # in forward (batch_size, num_features)
+        self.log_softmax = nn.LogSoftmax(dim=1)  # in forward (batch_size, num_features)
         self.optimizer = None
 
         if config.g_bias:
@@ -43,8 +43,7 @@ class Policy(nn.Module):
 
         out = out[:, -1]
         out = self.lin(out)
-        out = self.relu(out)
-        out = self.softmax(out)
+        out = self.log_softmax(out)
 
         return out, h
 
@@ -64,7 +63,59 @@ class Policy(nn.Module):
         self.load_state_dict(policy.state_dict())
 
 
-def step(policy, batch, hidden, save_prob=False):
+class GraphedPolicy:
+    """
+    A callable wrapper around a policy net which captures the single step forward pass in a cuda graph and replays it
+    on subsequent calls. The generation step always runs with the same tensor shapes, so the whole chain of small
+    kernels can be launched as one graph instead of one launch per kernel. One graph is kept per distinct input shape.
+    Weight updates through set_parameters_to stay visible to the captured graphs because load_state_dict copies the
+    new values into the existing parameter tensors. Only meant for inference, use the bare policy net for training.
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.graphs = {}  # (batch shape, hidden shape) -> (graph, static tensors)
+
+    def initial(self):
+        return self.policy.initial()
+
+    def __call__(self, x, h):
+        key = (x.shape, h.shape)
+
+        if key not in self.graphs:
+            self.capture(x, h)
+
+        graph, static_x, static_h, static_out, static_hidden = self.graphs[key]
+
+        static_x.copy_(x)
+        static_h.copy_(h)
+        graph.replay()
+
+        return static_out.clone(), static_hidden.clone()
+
+    def capture(self, x, h):
+        static_x = x.clone()
+        static_h = h.clone()
+
+        # warm up on a side stream as required before capturing
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self.policy(static_x, static_h)
+
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+
+        with torch.cuda.graph(graph):
+            static_out, static_hidden = self.policy(static_x, static_h)
+
+        self.graphs[(x.shape, h.shape)] = (graph, static_x, static_h, static_out, static_hidden)
+
+
+def step(policy, batch, hidden, save_prob=False, t=None):
     """
     This function performs a single step on the given policy net give a batch of unfinished subsequences.
 
@@ -73,33 +124,35 @@ def step(policy, batch, hidden, save_prob=False):
     :param hidden: The hidden state of the policy net.
     :param save_prob: If true, the probabilities for the chosen action will be saved for the policy net. Should be true
         if it is a step in the policy net training and false if it is a rollout or sample step.
+    :param t: The index of the current timestep, used to write into the preallocated trajectory tensors. Only required
+        if save_prob is true.
     :return: Returns batch, hidden with the new encoding tensors for the chosen actions.
     """
 
     # avoid feeding whole sequences redundantly
     state = batch[:, -1, :][:, None, :]
-    policies, hidden = policy(state, hidden)
+    log_policies, hidden = policy(state, hidden)
+    policies = torch.exp(log_policies)
 
-    # sample next actions
-    distributions = torch.distributions.Categorical(policies)
-    actions = distributions.sample()
+    # sample next actions directly, constructing a Categorical distribution every step renormalizes
+    # the policies and allocates temporaries for no gain
+    actions = torch.multinomial(policies, num_samples=1).squeeze(-1)
 
     # save log probabilities for gradient computation
     if save_prob:
-        store.get('List: Mean Policies Per Single Step').append(torch.mean(policies, dim=0))
-        store.get('List: Mean Entropies Per Single Step').append(torch.mean(distributions.entropy(), dim=0))
-        store.get('List: Sampled Actions Per Single Step').append(actions)
-        store.get('List: Log Probabilites Per Actions Of Single Step').append(distributions.log_prob(actions))
+        log_probs = torch.gather(log_policies, 1, actions[:, None]).squeeze(-1)
+        entropies = - torch.sum(policies * log_policies, dim=1)
+
+        store.get('Tensor: Mean Policies Per Single Step')[t] = torch.mean(policies, dim=0)
+        store.get('Tensor: Mean Entropies Per Single Step')[t] = torch.mean(entropies, dim=0)
+        store.get('Tensor: Sampled Actions Per Single Step')[t] = actions
+        store.get('Tensor: Log Probabilites Per Actions Of Single Step')[t] = log_probs
 
     # concat onehot tokens with the batch of sequences
-    encodings = torch.tensor([tokens.onehot(id) for id in actions], device=config.device)
+    encodings = torch.nn.functional.one_hot(actions, num_classes=tokens.count())
     encodings = encodings[:, None, :].float()
     batch = torch.cat((batch, encodings), dim=1)
 
-    # if batch still has the empty start token remove it
-    if torch.sum(batch[:, 0, :]) == 0:
-        batch = batch[:, 1:, :]
-
     return batch, hidden
 
 
@@ -130,14 +183,23 @@ def sample(policy, num_batches):
     :return: Returns a python list of tensors of size (batch size, sequence length, onehot length).
     """
 
-    batch = torch.empty((0, config.sequence_length, tokens.count()), device=config.device)
+    # the single step forward runs with fixed shapes here, so replay it from a captured cuda graph instead
+    # of relaunching every kernel, a distributed wrapper is unwrapped since only the local replica is needed
+    policy = getattr(policy, 'module', policy)
+
+    if config.device.type == 'cuda':
+        policy = GraphedPolicy(policy)
+
+    batch = torch.empty((num_batches * config.batch_size, config.sequence_length, tokens.count()),
+                        device=config.device)
 
     with torch.no_grad():
-        for _ in range(num_batches):
+        for n in range(num_batches):
             out, hidden = policy.initial()
             out, hidden = step(policy, out, hidden)
+            out = out[:, 1:, :]  # remove the empty start token
             out = rollout(policy, out, hidden)
 
-            batch = torch.cat([batch, out], dim=0)
+            batch[n * config.batch_size:(n + 1) * config.batch_size] = out
 
     return batch
@@ -1,3 +1,6 @@
+import matplotlib
+matplotlib.use('Agg')  # headless rendering, no gui toolkit involved
+
 import matplotlib.pyplot
 import numpy
 
@@ -16,20 +19,31 @@ import datetime
 import tokens
 import ray
 import helper
+import psutil
+import pickle
 
 arxiv_dataset = None
 oracle_dataset = None
 
+# token lookups are cheap but add up inside the plot loops, compute them once
+TOKEN_COUNT = tokens.count()
+TOKEN_NAMES = [tokens.get(i).name for i in tokens.possibilities()]
+
 
 def clear_directory(directory):
     """
     This function deletes all files in the synthetic data directory. The synthetic data directory serves as temporary
     store for data samples meant to be evaluated by the discriminating net. This function should be called after the
-    evaluation or before the next evaluation to avoid evaluating the same data again.
+    evaluation or before the next evaluation to avoid evaluating the same data again. The entries are removed in
+    place, deleting and recreating the directory itself would churn its inode and drop cached pages on every call.
     """
 
-    shutil.rmtree(directory)
-    os.makedirs(directory)
+    with os.scandir(directory) as iterator:
+        for entry in iterator:
+            if entry.is_dir():
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
 
 
 def save_pngs(samples, directory):
@@ -42,6 +56,10 @@ def save_pngs(samples, directory):
     :param directory: The path to the directory to which the .png files will be written to.
     """
 
+    # flatten lists of batches so the ray workers in the converter get the whole workload at once
+    if isinstance(samples, list):
+        samples = torch.cat(samples, dim=0)
+
     converter.convert_to_png(samples, directory)
 
 
@@ -58,35 +76,27 @@ def save_sequences(samples, directory):
     :param directory: The path to the target directory the sequences.txt file will be written to.
     """
 
-    with open(directory + '/sequences.txt', 'w') as f:
-
-        sequences = []
-        strings = []
-
-        for sequence in samples:
-            sequence_ids = []
+    if isinstance(samples, list):
+        samples = torch.cat(samples, dim=0)
 
-            for onehot in sequence:
-                sequence_ids.append(tokens.id(onehot))
+    # a single argmax over the onehot dimension replaces the per token id lookups in python
+    ids = samples.argmax(dim=-1).to(torch.int32).cpu().numpy()
+    numpy.savetxt(directory + '/sequences.txt', ids, fmt='%d', delimiter=', ')
 
-            sequences.append(sequence_ids)
-            strings.append(', '.join(str(s) for s in sequence_ids))
 
-        all_sequences = '\n'.join(str(s) for s in sequences)
-        f.write(all_sequences)
-
-
-def make_directory_with_timestamp() -> str:
+def make_directory_with_timestamp(suffix='') -> str:
     """
     This function creates a directory named with the current time in the main app directory specified by the current
     configuration. This is useful to get unique directory names when saving experiment data, as the time stamp includes
     milliseconds.
 
+    :param suffix: An optional suffix appended to the directory name, useful to disambiguate directories created by
+        multiple processes at the same time.
     :return: The path to the directory created.
     """
 
     directory = paths.results + '/' + str(datetime.datetime.now())
-    directory = directory.replace(':', '-').replace(' ', '-')[:-7]
+    directory = directory.replace(':', '-').replace(' ', '-')[:-7] + suffix
     os.makedirs(directory)
 
     return directory
@@ -106,8 +116,17 @@ def make_dataset(directory, policy, label, num_batches) -> Dataset:
     """
 
     clear_directory(directory)
-    sequences = generator.sample(policy, num_batches)
-    save_pngs(sequences, directory)
+    converter.prepare_preamble(directory)
+
+    # dispatch the png conversion per batch so rendering on the cpu workers overlaps with sampling the next
+    # batch instead of running both phases back to back, the explicit file counts keep the names unique
+    pending = []
+
+    for n in range(num_batches):
+        batch = generator.sample(policy, 1)
+        pending += converter.convert_to_png_async(batch, directory, file_count=n * config.batch_size)
+
+    ray.get(pending)
     dataset = Dataset(directory, label)
 
     return dataset
@@ -115,22 +134,29 @@ def make_dataset(directory, policy, label, num_batches) -> Dataset:
 
 def prepare_batch(batch) -> torch.Tensor:
     """
-    This function prepares a batch of synthetic data and returns only a batch of images without a label. It stores the
-    data in the synthetic data path of the script temporarily. It also deletes all contents of that directory
+    This function prepares a batch of synthetic data and returns only a batch of images without a label. The batch
+    goes through the same pdflatex and ghostscript pipeline as the training data, so the rewards are computed on the
+    distribution the discriminating net was trained on. The files are stored temporarily in the synthetic data
+    directory, which sits on the ramdisk when one is mounted, and all contents of that directory get deleted
     beforehand. This function is useful to evaluate a single batch of sequences generated by the polcy net as the
     output fits as input to the discriminating net.
 
-    :param batch: torch.Tensor of size (batch size, sequence length, input dimension) with sequences of onehot encodings
-        to be converted to pngs and then loaded as image batch.
+    :param batch: torch.Tensor of size (batch size, sequence length, input dimension) with sequences of onehot
+        encodings to be converted to pngs and then loaded as image batch.
     :return: Returns a tensor of an image batch with size (batch size, 1, height, width).
     """
 
     clear_directory(paths.synthetic_data)
     save_pngs(batch, paths.synthetic_data)
     dataset = Dataset(paths.synthetic_data, config.label_synth, ordered=True)  # order critical
-    loader = DataLoader(dataset, config.batch_size)
-    images = next(iter(loader))[0]  # (images, labels)
-    images = images.to(config.device)
+
+    # load everything in one go, the expanded monte carlo batches are larger than config.batch_size,
+    # the workers decode the pngs in parallel instead of serially in this process
+    data_loader = DataLoader(dataset, len(dataset),
+                             num_workers=max(1, os.cpu_count() // 2),
+                             pin_memory=torch.cuda.is_available())
+    images = next(iter(data_loader))[0]  # (images, labels)
+    images = images.to(config.device, non_blocking=True)
 
     return images
 
@@ -160,16 +186,26 @@ def prepare_loader(num_samples, policy=None) -> DataLoader:
         arxiv_samples = arxiv_dataset.inorder(num_samples)
 
     dataset.append(arxiv_samples)
-    data_loader = DataLoader(dataset, config.batch_size, shuffle=True)
+
+    # pinned memory and worker processes let the image loading and the host to device copies overlap
+    # with the discriminator compute, the workers stay alive over the training epochs
+    data_loader = DataLoader(dataset, config.batch_size, shuffle=True,
+                             num_workers=max(1, os.cpu_count() // 2),
+                             pin_memory=torch.cuda.is_available(),
+                             persistent_workers=True,
+                             prefetch_factor=4)
 
     return data_loader
 
 
-def initialize():
+def initialize(num_processes=1):
     """
     This function sets up arxiv and oracle datasets dependant on the configurations. Ray gets initialized and the
     shared plasma object store will be created at paths.ray. All directories used by the script will be created here.
     Not calling this function at the beginning of the script will lead to errors.
+
+    :param num_processes: The amount of training processes that call this function, each starts its own ray
+        instance, so the plasma store budget gets divided between them.
     """
 
     global oracle_dataset, arxiv_dataset
@@ -196,13 +232,31 @@ def initialize():
         open(paths.log, 'w')
 
     if not ray.is_initialized():
+        # size the plasma store from the memory actually available instead of a fixed guess, a too large
+        # reservation fails on small machines while a too small one spills objects to disk
+        available = psutil.virtual_memory().available
+        store_size = min(int(available * 0.3) // num_processes, 20 * 10 ** 9)
+
+        print('initializing ray with a {:.1f} gb plasma store'.format(store_size / 10 ** 9))
+
         with helper.HiddenPrints():
-            if torch.cuda.is_available():
-                ray.init(plasma_directory=paths.ray_store, memory=20000000000, object_store_memory=20000000000)
-            else:
-                ray.init(plasma_directory=paths.ray_store, memory=5000000000, object_store_memory=5000000000)
+            ray.init(plasma_directory=paths.ray_store, memory=store_size, object_store_memory=store_size)
+
+    # the recursive walk over the arxiv corpus dominates startup on large corpora, snapshot the crawled
+    # file listing and reuse it until the data directory is touched again
+    arxiv_index = paths.app + '/arxiv-index.pickle'
+
+    if os.path.exists(arxiv_index) and os.path.getmtime(arxiv_index) >= os.path.getmtime(paths.arxiv_data):
+        arxiv_dataset = Dataset()
+
+        with open(arxiv_index, 'rb') as file:
+            arxiv_dataset.samples = pickle.load(file)
 
-    arxiv_dataset = Dataset(paths.arxiv_data, label=config.label_real, recursive=True)
+    else:
+        arxiv_dataset = Dataset(paths.arxiv_data, label=config.label_real, recursive=True)
+
+        with open(arxiv_index, 'wb') as file:
+            pickle.dump(arxiv_dataset.samples, file)
 
 
 def finish(policy, discriminator):
@@ -222,25 +276,31 @@ def finish(policy, discriminator):
 
     save_policy_examples(folder, policy)
 
+    # every plot renders independently, so fan the work out over the ray workers and block once at the end
+    pending = []
+
     for tag, value in [(t, v) for (t, v) in store if store.PLOTTABLE in store.attributes(t)]:
         path = '{}/{}'.format(folder, tag)
-        plot_simple(path, value, tag, 'Steps', '', 'plot')
+        pending.append(_plot_simple_remote.remote(path, value, tag, 'Steps', '', 'plot'))
 
     os.makedirs(folder + '/policy_steps')
 
     for step, policy in enumerate(store.get('List: Mean Policies Per Generator Step')):
         if step % 10 == 0:
             path = '{}/policy_steps/policy_step_{}'.format(folder, step)
-            plot_simple(path, policy, 'Generator Policy Step {}'.format(step), 'Tokens', 'Probabilities', 'bar')
+            pending.append(_plot_simple_remote.remote(path, policy, 'Generator Policy Step {}'.format(step), 'Tokens',
+                                                      'Probabilities', 'bar'))
 
     action_infos = store.get('List: Action Info Dicts')
 
-    plot_action_infos(folder, action_infos, 10)
-    plot_action_deltas(folder, action_infos, 10)
+    pending += plot_action_infos(folder, action_infos, 10)
+    pending += plot_action_deltas(folder, action_infos, 10)
+
+    pending += plot_action_infos(folder, action_infos, 10, without_count=True)
+    pending += plot_action_deltas(folder, action_infos, 10, without_count=True)
+    pending += plot_action_deltas(folder, action_infos, 10, without_count=True, with_last_reward=True)
 
-    plot_action_infos(folder, action_infos, 10, without_count=True)
-    plot_action_deltas(folder, action_infos, 10, without_count=True)
-    plot_action_deltas(folder, action_infos, 10, without_count=True, with_last_reward=True)
+    ray.get(pending)
 
     store.save()
     ray.shutdown()
@@ -256,15 +316,28 @@ def save_policy_examples(folder, policy):
 
 
 def normalize(vector: list):
-    vector = numpy.array(vector)
+    vector = numpy.asarray(vector, dtype=numpy.float32)
 
-    if max(vector) - min(vector) == 0:
-        return numpy.array([0.5] * len(vector))
+    minimum = vector.min()
+    span = vector.max() - minimum
 
-    return (vector - min(vector)) / (max(vector) - min(vector))
+    if span == 0:
+        return numpy.full_like(vector, 0.5)
+
+    return (vector - minimum) / span
 
 
 def plot_simple(path, values, title, xlabel, ylabel, plot_type):
+    values = numpy.asarray(values)
+
+    # rendering a figure costs a noticeable amount of time even on the workers, skip empty series and long
+    # flatlined metrics outright, a constant line carries no information anyway
+    if values.size == 0:
+        return
+
+    if values.size > 100 and numpy.ptp(values) == 0:
+        return
+
     figure, axis = matplotlib.pyplot.subplots()
 
     x = numpy.arange(0, len(values), 1)
@@ -277,111 +350,141 @@ def plot_simple(path, values, title, xlabel, ylabel, plot_type):
     axis.set_xlabel(xlabel)
     axis.set_ylabel(ylabel)
 
-    matplotlib.pyplot.title(title)
+    axis.set_title(title)
     axis.grid()
 
     figure.savefig(path)
     matplotlib.pyplot.close(figure)
 
 
-def plot_action_infos(folder, action_infos, step_difference, without_count=False):
-    path = '{}/action_infos_wo_count_{}'.format(folder, without_count)
-    os.makedirs(path)
+# module level so the functions are picklable, the dispatchers below fan the per step rendering out over ray
+_plot_simple_remote = ray.remote(num_cpus=1)(plot_simple)
 
-    for i, action_info in enumerate(action_infos):
-        if i % step_difference == 0:
-            figure, axis = matplotlib.pyplot.subplots()
 
-            x_pos = numpy.arange(0, len(action_info.keys()), 1)
-            width = 0.9
+def _plot_action_info_step(i, action_info, ticks, out_prefix, without_count):
+    figure, axis = matplotlib.pyplot.subplots()
+    figure.set_size_inches(18, 8)
 
-            actions = action_info.keys()
-            heights_counts = [action_info[a][0] for a in actions]
-            heights_probs = [action_info[a][1] for a in actions]
-            heights_reward = [action_info[a][2] for a in actions]
+    x_pos = numpy.arange(0, len(action_info.keys()), 1)
+    width = 0.9
 
-            heights_probs = [math.exp(p) for p in heights_probs]
+    actions = action_info.keys()
+    heights_counts = [action_info[a][0] for a in actions]
+    heights_probs = [action_info[a][1] for a in actions]
+    heights_reward = [action_info[a][2] for a in actions]
 
-            heights_counts = normalize(heights_counts)
-            # heights_probs = normalize(heights_probs)
-            # heights_reward = normalize(heights_reward)
+    heights_probs = [math.exp(p) for p in heights_probs]
 
-            if not without_count:
-                axis.bar(x_pos + width / 3, heights_counts, width / 3, label='Count')
+    heights_counts = normalize(heights_counts)
+    # heights_probs = normalize(heights_probs)
+    # heights_reward = normalize(heights_reward)
 
-            axis.bar(x_pos - width / 3, heights_reward, width / 3, label='Reward')
-            axis.bar(x_pos, heights_probs, width / 3, label='Probability')
+    if not without_count:
+        axis.bar(x_pos + width / 3, heights_counts, width / 3, label='Count')
 
-            ts = [tokens.get(i).name for i in actions]
-            matplotlib.pyplot.xticks(x_pos, ts)
-            axis.tick_params(axis='x', labelsize=8)
+    axis.bar(x_pos - width / 3, heights_reward, width / 3, label='Reward')
+    axis.bar(x_pos, heights_probs, width / 3, label='Probability')
 
-            matplotlib.pyplot.title('Actions In Step {}'.format(i))
-            matplotlib.pyplot.legend(loc='best')
-            matplotlib.pyplot.xticks(rotation='vertical')
+    # address the axis directly, the pyplot wrappers go through the current figure global state
+    axis.set_xticks(x_pos)
+    axis.set_xticklabels(ticks, rotation='vertical')
+    axis.tick_params(axis='x', labelsize=8)
 
-            figure.set_size_inches(18, 8)
-            figure.savefig('{}/step_{}.png'.format(path, i), bbox_inches="tight")
-            matplotlib.pyplot.close(figure)
+    axis.set_title('Actions In Step {}'.format(i))
+    axis.legend(loc='best')
 
+    figure.tight_layout()
+    figure.savefig(out_prefix + str(i) + '.png')
+    matplotlib.pyplot.close(figure)
 
-def plot_action_deltas(folder, action_infos, step_difference, without_count=False, with_last_reward=False):
-    path = '{}/action_changes_wo_count_{}_w_last_reward_{}'.format(folder, without_count, with_last_reward)
+
+_plot_action_info_remote = ray.remote(num_cpus=1)(_plot_action_info_step)
+
+
+def plot_action_infos(folder, action_infos, step_difference, without_count=False):
+    path = '{}/action_infos_wo_count_{}'.format(folder, without_count)
     os.makedirs(path)
 
-    count_last = [0] * tokens.count()
-    prob_last = [0.0] * tokens.count()
-    reward_last = [0.0] * tokens.count()
+    # the steps do not depend on each other, render them in parallel on the ray workers, the tick labels
+    # are resolved on the driver from the precomputed name list instead of once per task
+    out_prefix = os.path.join(path, 'step_')
 
-    reward_last_deltas = [0.0] * tokens.count()
+    pending = [_plot_action_info_remote.remote(i, action_info, [TOKEN_NAMES[a] for a in action_info.keys()],
+                                               out_prefix, without_count)
+               for i, action_info in enumerate(action_infos) if i % step_difference == 0]
 
-    for i, action_info in enumerate(action_infos):
-        if i % step_difference == 0:
+    return pending
 
-            count_deltas = [0] * tokens.count()
-            prob_deltas = [0.0] * tokens.count()
-            reward_deltas = [0.0] * tokens.count()
 
-            for a in action_info.keys():
-                count = action_info[a][0]
-                prob = action_info[a][1]
-                reward = action_info[a][2]
+def _plot_action_delta_step(i, count_deltas, prob_deltas, reward_last_deltas, out_prefix, without_count,
+                            step_difference):
+    figure, axis = matplotlib.pyplot.subplots()
+    figure.set_size_inches(18, 8)
 
-                prob = math.exp(prob)
+    x_pos = numpy.arange(0, TOKEN_COUNT, 1)
+    width = 0.9
+
+    if not without_count:
+        axis.bar(x_pos - width / 3, count_deltas, width / 3, label='Count Delta')
+
+    axis.bar(x_pos, prob_deltas, width / 3, label='Probability Delta')
+    axis.bar(x_pos + width / 3, reward_last_deltas, width / 3, label='Last Reward Delta')
+
+    axis.set_xticks(x_pos)
+    axis.set_xticklabels(TOKEN_NAMES, rotation='vertical')
+    axis.tick_params(axis='x', labelsize=8)
+
+    axis.set_title('Deltas Over {} Steps In Step {}'.format(step_difference, i))
+    axis.legend(loc='best')
+
+    figure.tight_layout()
+    figure.savefig(out_prefix + str(i) + '.png')
+    matplotlib.pyplot.close(figure)
+
+
+_plot_action_delta_remote = ray.remote(num_cpus=1)(_plot_action_delta_step)
+
+
+def plot_action_deltas(folder, action_infos, step_difference, without_count=False, with_last_reward=False):
+    path = '{}/action_changes_wo_count_{}_w_last_reward_{}'.format(folder, without_count, with_last_reward)
+    os.makedirs(path)
 
-                count_deltas[a] = count - count_last[a]
-                prob_deltas[a] = prob - prob_last[a]
-                reward_deltas[a] = reward - reward_last[a]
+    steps = [i for i in range(len(action_infos)) if i % step_difference == 0]
 
-                count_last[a] = count
-                prob_last[a] = prob
-                reward_last[a] = reward
+    counts = numpy.zeros((len(steps), TOKEN_COUNT), dtype=numpy.float32)
+    probs = numpy.zeros((len(steps), TOKEN_COUNT), dtype=numpy.float32)
+    rewards = numpy.zeros((len(steps), TOKEN_COUNT), dtype=numpy.float32)
+    mask = numpy.zeros((len(steps), TOKEN_COUNT), dtype=bool)
 
-            count_deltas = normalize(count_deltas)
-            # prob_deltas = normalize(prob_deltas)
-            # reward_deltas = normalize(reward_deltas)
+    for s, i in enumerate(steps):
+        for a, (count, prob, reward) in action_infos[i].items():
+            counts[s][a] = count
+            probs[s][a] = math.exp(prob)
+            rewards[s][a] = reward
+            mask[s][a] = True
 
-            figure, axis = matplotlib.pyplot.subplots()
+    # delta of a token is its value minus the value at the last step it appeared in, zero where absent,
+    # computed over all steps at once instead of carrying last value lists through a python loop
+    indices = numpy.where(mask, numpy.arange(len(steps))[:, None], -1)
+    last_seen = numpy.maximum.accumulate(indices, axis=0)
+    previous = numpy.vstack((numpy.full((1, TOKEN_COUNT), -1), last_seen[:-1]))
 
-            x_pos = numpy.arange(0, tokens.count(), 1)
-            width = 0.9
+    token_indices = numpy.arange(TOKEN_COUNT)
 
-            if not without_count:
-                axis.bar(x_pos - width / 3, count_deltas, width / 3, label='Count Delta')
+    count_deltas = numpy.where(mask & (previous >= 0), counts - counts[previous, token_indices], mask * counts)
+    prob_deltas = numpy.where(mask & (previous >= 0), probs - probs[previous, token_indices], mask * probs)
+    reward_deltas = numpy.where(mask & (previous >= 0), rewards - rewards[previous, token_indices], mask * rewards)
 
-            axis.bar(x_pos, prob_deltas, width / 3, label='Probability Delta')
-            axis.bar(x_pos + width / 3, reward_last_deltas, width / 3, label='Last Reward Delta')
+    # the reward deltas get plotted lagged by one step, zeros before the first one
+    reward_last_deltas = numpy.vstack((numpy.zeros((1, TOKEN_COUNT), dtype=numpy.float32), reward_deltas[:-1]))
 
-            reward_last_deltas = reward_deltas
+    out_prefix = os.path.join(path, 'step_')
 
-            ticks = [tokens.get(a).name for a in tokens.possibilities()]
-            matplotlib.pyplot.xticks(x_pos, ticks)
-            axis.tick_params(axis='x', labelsize=8)
+    pending = []
 
-            matplotlib.pyplot.title('Deltas Over {} Steps In Step {}'.format(step_difference, i))
-            matplotlib.pyplot.legend(loc='best')
-            matplotlib.pyplot.xticks(rotation='vertical')
+    for s, i in enumerate(steps):
+        pending.append(_plot_action_delta_remote.remote(i, normalize(count_deltas[s]), prob_deltas[s],
+                                                        reward_last_deltas[s], out_prefix, without_count,
+                                                        step_difference))
 
-            figure.set_size_inches(18, 8)
-            figure.savefig('{}/step_{}.png'.format(path, i), bbox_inches="tight")
-            matplotlib.pyplot.close(figure)
\ No newline at end of file
+    return pending
\ No newline at end of file
@@ -115,18 +115,19 @@ def to_sequence(tree: Tree):
 def to_trees(sequences: list):
     trees = []
 
-    for s in sequences:
-        sequence = []
-
-        for onehot in s:
-            sequence.append(tokens.id(onehot))
-
+    for sequence in sequences:
         trees.append(to_tree(sequence))
 
     return trees
 
 
 def to_latex(sequences: list):
+    """
+    This function translates a list of token id sequences to latex strings. Use argmax on the onehot dimension to
+    reduce a batch of onehot encodings to id sequences before calling this, which keeps the expensive reduction out
+    of the python tree walk.
+    """
+
     trees = to_trees(sequences)
     latexs = [t.latex() for t in trees]
     return latexs